@@ -1,9 +1,120 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import connection
+from django.utils.functional import cached_property
 
-from .models import Player, Game, Challenge, PlayerScore, Setting
+from .models import Player, Game, Challenge, PlayerScore, Setting, Achievement, Group
+from .views import queue_resync
 
-admin.site.register(Player)
-admin.site.register(Game)
-admin.site.register(Challenge)
-admin.site.register(PlayerScore)
-admin.site.register(Setting)
\ No newline at end of file
+# Below this many rows an exact COUNT(*) is cheap enough
+ESTIMATE_COUNT_THRESHOLD = 100000
+
+def get_estimated_count(table: str):
+    '''
+    Returns the row count estimate from the database's statistics, or None if the backend doesn't keep one
+    '''
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute('SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s', [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] and row[0] > 0 else None
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    Paginator that uses the table statistics instead of COUNT(*) for unfiltered changelists of large tables
+    '''
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        if not query.where:
+            estimate = get_estimated_count(self.object_list.model._meta.db_table)
+            if estimate and estimate > ESTIMATE_COUNT_THRESHOLD:
+                return estimate
+        return super().count
+
+class PlayerSearchMixin:
+    '''
+    Searches by exact player name. The player is looked up first so the search filters on player_id
+    and uses the index, rather than joining the player table for every row.
+    '''
+    search_fields = ('player__name__exact',)
+    search_help_text = 'Exact player name'
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        player_id = Player.objects.filter(name=search_term).values_list('id', flat=True).first()
+        return queryset.filter(player_id=player_id) if player_id else queryset.none(), False
+
+@admin.register(Player)
+class PlayerAdmin(admin.ModelAdmin):
+    list_display = ('name', 'is_active')
+    list_filter = ('is_active', 'groups')
+    search_fields = ('name',)
+    actions = ('activate_players', 'deactivate_players', 'resync_player')
+
+    @admin.action(description='Activate selected players')
+    def activate_players(self, request, queryset):
+        updated = queryset.update(is_active=True)
+        self.message_user(request, f'Activated {updated} player(s)')
+
+    @admin.action(description='Deactivate selected players')
+    def deactivate_players(self, request, queryset):
+        updated = queryset.update(is_active=False)
+        self.message_user(request, f'Deactivated {updated} player(s)')
+
+    @admin.action(description='Resync selected player for their current challenges')
+    def resync_player(self, request, queryset):
+        players = list(queryset[:2])
+        if len(players) != 1:
+            self.message_user(request, 'Select exactly one player to resync', messages.ERROR)
+            return
+        # A resync can take longer than the worker timeout, so it's queued rather than run in the request
+        queue_resync(players[0])
+        self.message_user(request, f'Queued {players[0].name} for the next `manage.py resync_player --queued` '
+                                   f'or refresh_groups run')
+
+@admin.register(Group)
+class GroupAdmin(admin.ModelAdmin):
+    list_display = ('name', 'slug')
+    search_fields = ('name', 'slug')
+    prepopulated_fields = {'slug': ('name',)}
+    filter_horizontal = ('players',)
+
+@admin.register(Challenge)
+class ChallengeAdmin(admin.ModelAdmin):
+    list_display = ('id', 'start', 'end', 'group')
+    list_filter = ('group',)
+    list_select_related = ('group',)
+
+@admin.register(Game)
+class GameAdmin(admin.ModelAdmin):
+    list_display = ('name', 'retro_game_id', 'challenge')
+    list_filter = ('challenge__group', 'challenge')
+    list_select_related = ('challenge__group',)
+    search_fields = ('name', '=retro_game_id')
+
+@admin.register(PlayerScore)
+class PlayerScoreAdmin(PlayerSearchMixin, admin.ModelAdmin):
+    list_display = ('player', 'game', 'score', 'raw_score')
+    list_filter = ('game__challenge__group', 'game__challenge', 'player__is_active')
+    list_select_related = ('player', 'game__challenge__group')
+    autocomplete_fields = ('player', 'game')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+@admin.register(Achievement)
+class AchievementAdmin(PlayerSearchMixin, admin.ModelAdmin):
+    list_display = ('achievement_id', 'title', 'player', 'game', 'date', 'hardcore', 'points')
+    list_filter = ('game__challenge__group', 'game__challenge', 'hardcore')
+    list_select_related = ('player', 'game__challenge__group')
+    autocomplete_fields = ('player', 'game')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+admin.site.register(Setting)
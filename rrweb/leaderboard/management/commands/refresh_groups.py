@@ -0,0 +1,84 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from leaderboard.models import Game
+from leaderboard.retro import SharedRAclient
+from leaderboard.views import DATE_FORMAT, get_current_challenges, get_last_run, get_login, refresh_leaderboard_smart, run_queued_resyncs
+
+class Command(BaseCommand):
+    help = 'Refreshes the current challenge of every group in parallel, sharing API results between groups'
+
+    def add_arguments(self, parser):
+        # SQLite only allows one writer at a time, so parallel refreshes would just wait on each other's locks
+        default_workers = 1 if connection.vendor == 'sqlite' else 4
+        parser.add_argument('--workers', type=int, default=default_workers,
+                            help=f'How many groups to refresh at once (default {default_workers})')
+        parser.add_argument('--group', action='append', dest='groups',
+                            help='Slug of a group to refresh, can be given more than once. Defaults to every group')
+
+    def handle(self, *args, **options):
+        challenges = list(get_current_challenges())
+        if options['groups']:
+            challenges = [challenge for challenge in challenges if challenge.group_id and challenge.group.slug in options['groups']]
+
+        username, api_key = get_login()
+        client = SharedRAclient(username, api_key)
+        # Not in a web request, so wait out throttling rather than giving up
+        client.max_wait = None
+        workers = max(1, options['workers'])
+
+        # Players queued for a resync from the admin
+        resynced = run_queued_resyncs(client)
+        if resynced:
+            self.stdout.write(f'Resynced {", ".join(resynced)}')
+
+        self.prefetch_progress(client, challenges, workers)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.refresh, client, challenge): challenge for challenge in challenges}
+            for future in as_completed(futures):
+                challenge = futures[future]
+                try:
+                    updated = future.result()
+                    self.stdout.write(f'Challenge {challenge}: updated {updated or "nobody"}')
+                except Exception as e:
+                    self.stderr.write(f'Challenge {challenge} failed: {e}')
+
+        if getattr(settings, 'LEADERBOARD_STATIC_ROOT', None):
+            from leaderboard.static_export import render_static_leaderboard
+            render_static_leaderboard(settings.LEADERBOARD_STATIC_ROOT, groups=[challenge.group for challenge in challenges])
+
+    def prefetch_progress(self, client: SharedRAclient, challenges: list, workers: int):
+        '''
+        Gets progress for every game a player has across all their groups in one go,
+        rather than once per group
+        '''
+        player_game_ids = defaultdict(set)
+        for challenge in challenges:
+            game_ids = list(Game.objects.filter(challenge=challenge).values_list('retro_game_id', flat=True))
+            for name in challenge.get_players().values_list('name', flat=True):
+                player_game_ids[name].update(game_ids)
+
+        # Failed games are left out of the cache, so the refresh itself will try them again
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for name, game_ids in player_game_ids.items():
+                executor.submit(client.get_user_progress, name, list(game_ids))
+
+    def refresh(self, client: SharedRAclient, challenge):
+        try:
+            last_run = get_last_run(challenge.group)
+            previous_run = last_run.value
+            last_run.value = timezone.now().strftime(DATE_FORMAT)
+            last_run.save()
+            try:
+                return refresh_leaderboard_smart(challenge.id, client=client)
+            except Exception:
+                last_run.value = previous_run
+                last_run.save()
+                raise
+        finally:
+            # Each thread gets its own database connection, which Django won't close for us
+            connection.close()
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from leaderboard.static_export import render_static_leaderboard
+
+class Command(BaseCommand):
+    help = 'Renders the leaderboard and past challenges to precompressed static files that nginx can serve directly'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output-dir', default=getattr(settings, 'LEADERBOARD_STATIC_ROOT', None),
+                            help='Directory to write to. Defaults to settings.LEADERBOARD_STATIC_ROOT')
+        parser.add_argument('--rerender-archive', action='store_true',
+                            help='Re-render past challenges even if they were already rendered')
+
+    def handle(self, *args, **options):
+        output_dir = options['output_dir']
+        if not output_dir:
+            raise CommandError('No output directory, pass --output-dir or set LEADERBOARD_STATIC_ROOT')
+
+        rendered = render_static_leaderboard(output_dir, options['rerender_archive'])
+        self.stdout.write(f'Rendered challenges {", ".join(str(id) for id in rendered) or "(none)"} to {output_dir}')
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from leaderboard.models import Player
+from leaderboard.retro import RAclient
+from leaderboard.views import get_login, resync_player, run_queued_resyncs
+
+class Command(BaseCommand):
+    help = "Refetches a player's achievements for every current challenge they're in"
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', nargs='?', help='The player to resync')
+        parser.add_argument('--queued', action='store_true', help='Resync the players queued from the admin')
+
+    def handle(self, *args, **options):
+        if not options['name'] and not options['queued']:
+            raise CommandError('Give a player name or --queued')
+
+        username, api_key = get_login()
+        client = RAclient(username, api_key)
+        # Not in a web request, so wait out throttling rather than giving up
+        client.max_wait = None
+
+        if options['name']:
+            player = Player.objects.filter(name=options['name']).first()
+            if not player:
+                raise CommandError(f'No player named {options["name"]}')
+            resync_player(player, client)
+            self.stdout.write(f'Resynced {player.name}')
+
+        if options['queued']:
+            resynced = run_queued_resyncs(client)
+            self.stdout.write(f'Resynced {", ".join(resynced) or "nobody"}')
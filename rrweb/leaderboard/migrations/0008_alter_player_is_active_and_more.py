@@ -0,0 +1,30 @@
+# Generated by Django 4.1.7 on 2026-10-19 04:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboard', '0007_playerscore_raw_score'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='player',
+            name='is_active',
+            field=models.BooleanField(db_index=True, default=True),
+        ),
+        migrations.AddIndex(
+            model_name='achievement',
+            index=models.Index(fields=['player', 'date'], name='leaderboard_player__25d33a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='achievement',
+            index=models.Index(fields=['player', 'game', 'hardcore'], name='leaderboard_player__c4e50a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='playerscore',
+            index=models.Index(fields=['player', 'game'], name='leaderboard_player__bfee73_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-19 04:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboard', '0008_alter_player_is_active_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Group',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('slug', models.SlugField(unique=True)),
+                ('players', models.ManyToManyField(blank=True, related_name='groups', to='leaderboard.player')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='challenge',
+            name='group',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='leaderboard.group'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-19 04:39
+
+from django.db import migrations, models
+import leaderboard.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('leaderboard', '0009_group_challenge_group'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='game',
+            name='retro_game_id',
+            field=models.IntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='group',
+            name='slug',
+            field=models.SlugField(unique=True, validators=[leaderboard.models.validate_group_slug]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='game',
+            unique_together={('challenge', 'retro_game_id')},
+        ),
+    ]
@@ -1,23 +1,51 @@
+from django.core.exceptions import ValidationError
 from django.db import models
 
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 class Player(models.Model):
     name = models.CharField(max_length=50, unique=True)
-    is_active = models.BooleanField(default=True)
+    is_active = models.BooleanField(default=True, db_index=True)
 
     def __str__(self):
         return f'{self.name}, {self.is_active}'
 
+# Group slugs are used in /leaderboard/<slug>/ and as static export directories, so they can't clash with those
+RESERVED_GROUP_SLUGS = ('update', 'refresh_games', 'challenges')
+
+def validate_group_slug(value: str):
+    if value.lower() in RESERVED_GROUP_SLUGS:
+        raise ValidationError(f'"{value}" is reserved, pick another slug')
+
+class Group(models.Model):
+    '''A bracket with its own roster and challenges, so several rumbles can run at once'''
+    name = models.CharField(max_length=100)
+    slug = models.SlugField(unique=True, validators=[validate_group_slug])
+    players = models.ManyToManyField(Player, blank=True, related_name='groups')
+
+    def __str__(self):
+        return self.name
+
 class Challenge(models.Model):
     start = models.IntegerField()
     end = models.IntegerField()
+    # Challenges without a group use every active player, as before groups existed
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, null=True, blank=True)
 
     def __str__(self):
-        return f'{self.id}, {self.start} to {self.end}'
+        return f'{self.id}, {self.start} to {self.end}{f" ({self.group})" if self.group_id else ""}'
+
+    def get_players(self):
+        '''
+        The active players taking part in this challenge
+        '''
+        players = Player.objects.filter(is_active=True)
+        if self.group_id:
+            players = players.filter(groups__id=self.group_id)
+        return players
 
 class Game(models.Model):
-    retro_game_id = models.IntegerField(unique=True)
+    retro_game_id = models.IntegerField()
     challenge = models.ForeignKey(Challenge, on_delete=models.CASCADE)
     name = models.CharField(max_length=100)
     image_icon = models.CharField(max_length=50, null=True)
@@ -27,6 +55,10 @@ class Game(models.Model):
     image_box_art = models.CharField(max_length=50, null=True)
     # max_score maybe for showing NN/MM
 
+    class Meta:
+        # Brackets usually share a game list, so a game only has to be unique within its challenge
+        unique_together = ('challenge', 'retro_game_id')
+
     def __str__(self):
         return f'{self.id}, {self.name}, Challenge: {self.challenge}'
 
@@ -36,6 +68,11 @@ class PlayerScore(models.Model):
     score = models.IntegerField(default=0)
     raw_score = models.IntegerField(default=0)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['player', 'game']),
+        ]
+
     def __str__(self):
         return f'{self.player.name}, {self.game.name}: {self.score}'
     
@@ -56,5 +93,13 @@ class Achievement(models.Model):
     hardcore = models.BooleanField()
     points = models.IntegerField()
 
+    class Meta:
+        indexes = [
+            # Latest achievement per player, for incremental refreshes
+            models.Index(fields=['player', 'date']),
+            # Hardcore points per player and game
+            models.Index(fields=['player', 'game', 'hardcore']),
+        ]
+
     def __str__(self) -> str:
         return f'{self.achievement_id}: {self.date.strftime(DATE_FORMAT)}, {self.points} {"(Hardcore)" if self.hardcore else ""}'
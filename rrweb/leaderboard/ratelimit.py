@@ -0,0 +1,157 @@
+import random
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime
+from enum import IntEnum
+
+GLOBAL_BUCKET = '*'
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BULK = 1
+
+class QuotaExceeded(Exception):
+    '''Raised when the daily request quota has been used up'''
+    pass
+
+class RateLimited(Exception):
+    '''Raised when a token wouldn't be available within the caller's max_wait'''
+    pass
+
+class Budget:
+    '''A token bucket: refills `rate` tokens per second, holding at most `burst` tokens'''
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+
+    def __repr__(self) -> str:
+        return f'{self.rate}/s, burst {self.burst}'
+
+class RateLimiter:
+    '''
+    Token bucket rate limiter shared by every process on the machine.
+
+    State lives in its own SQLite file rather than the Django database, so it's shared between
+    gunicorn workers and management commands, and isn't held back by an open transaction.atomic
+    block in the caller. BEGIN IMMEDIATE takes the write lock, so the read-refill-consume is atomic.
+
+    Every request takes a token from the global bucket and from its endpoint's bucket, if it has one.
+    Bulk requests leave `bulk_reserve` of each bucket (and of the daily quota) for interactive ones.
+    '''
+    def __init__(self, path: str, budget: Budget, endpoint_budgets: dict = None, daily_quota: int = None,
+                 bulk_reserve: float = 0.5, max_sleep: float = 5.0):
+        self.path = str(path)
+        self.budgets = {GLOBAL_BUCKET: budget} | (endpoint_budgets or dict())
+        self.daily_quota = daily_quota
+        self.bulk_reserve = bulk_reserve
+        self.max_sleep = max_sleep
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL, blocked_until REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS quota (day TEXT PRIMARY KEY, used INTEGER)')
+
+    def _connect(self):
+        # A fresh connection per call keeps this safe to use from threads as well as processes
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _keys(self, endpoint: str):
+        return [GLOBAL_BUCKET, endpoint] if endpoint in self.budgets else [GLOBAL_BUCKET]
+
+    def _load(self, conn, key: str, now: float):
+        budget = self.budgets[key]
+        row = conn.execute('SELECT tokens, updated, blocked_until FROM bucket WHERE key = ?', (key,)).fetchone()
+        if not row:
+            return (budget.burst, 0.0)
+        tokens, updated, blocked_until = row
+        tokens = min(budget.burst, tokens + max(0.0, now - max(updated, blocked_until)) * budget.rate)
+        return (tokens, blocked_until)
+
+    def _store(self, conn, key: str, tokens: float, now: float, blocked_until: float):
+        conn.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated, blocked_until) VALUES (?, ?, ?, ?)',
+                     (key, tokens, now, blocked_until))
+
+    def _reserve(self, priority: Priority):
+        return self.bulk_reserve if priority == Priority.BULK else 0.0
+
+    def try_acquire(self, endpoint: str, priority: Priority = Priority.INTERACTIVE):
+        '''
+        Takes a token if one is available. Returns 0 on success, otherwise the seconds to wait before trying again.
+        '''
+        now = time.time()
+        day = datetime.utcfromtimestamp(now).strftime('%Y-%m-%d')
+        reserve = self._reserve(priority)
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+
+            if self.daily_quota:
+                row = conn.execute('SELECT used FROM quota WHERE day = ?', (day,)).fetchone()
+                used = row[0] if row else 0
+                if used >= self.daily_quota * (1 - reserve):
+                    raise QuotaExceeded(f'Daily quota of {self.daily_quota} requests used up ({used} made today)')
+
+            buckets = dict()
+            wait = 0.0
+            for key in self._keys(endpoint):
+                tokens, blocked_until = self._load(conn, key, now)
+                budget = self.budgets[key]
+                needed = 1 + budget.burst * reserve
+                wait = max(wait, blocked_until - now, (needed - tokens) / budget.rate)
+                buckets[key] = (tokens, blocked_until)
+
+            if wait <= 0:
+                for key, (tokens, blocked_until) in buckets.items():
+                    self._store(conn, key, tokens - 1, now, blocked_until)
+                if self.daily_quota:
+                    conn.execute('INSERT INTO quota (day, used) VALUES (?, 1) ON CONFLICT(day) DO UPDATE SET used = used + 1', (day,))
+                    conn.execute('DELETE FROM quota WHERE day < ?', (day,))
+            conn.execute('COMMIT')
+            return max(wait, 0.0)
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def acquire(self, endpoint: str, priority: Priority = Priority.INTERACTIVE, max_wait: float = None):
+        '''
+        Blocks until a token is available for the endpoint.
+        Raises RateLimited rather than waiting past max_wait seconds, if it's given.
+        '''
+        deadline = time.time() + max_wait if max_wait is not None else None
+        while True:
+            wait = self.try_acquire(endpoint, priority)
+            if wait <= 0:
+                return
+            if deadline is not None and time.time() + wait > deadline:
+                raise RateLimited(f'No token for {endpoint} within {max_wait}s, next one in {wait:.1f}s')
+            # Jitter so waiting processes don't all wake up and contend for the same token
+            time.sleep(min(wait, self.max_sleep) * random.uniform(1.0, 1.25))
+
+    def penalize(self, endpoint: str, seconds: float):
+        '''
+        Empties the buckets and blocks them for `seconds`, e.g. after the API responds with 429.
+        Every process backs off together rather than each one retrying into the throttle.
+        '''
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for key in self._keys(endpoint):
+                tokens, blocked_until = self._load(conn, key, now)
+                self._store(conn, key, 0.0, now, max(blocked_until, now + seconds))
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def get_quota_used(self):
+        day = datetime.utcnow().strftime('%Y-%m-%d')
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT used FROM quota WHERE day = ?', (day,)).fetchone()
+        return row[0] if row else 0
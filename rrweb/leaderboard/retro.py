@@ -1,10 +1,42 @@
 import json
+import logging
+import os
+import tempfile
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from datetime import datetime
 import pytz
 import requests
 from dateutil.relativedelta import relativedelta
+from django.conf import settings
 from leaderboard.models import Player, Game, Challenge, PlayerScore, Setting
+from leaderboard.ratelimit import RateLimiter, RateLimited, Budget, Priority
+
+REQUEST_TIMEOUT_SECONDS = 30
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 5
+# The longest we block every process for after being throttled, longer than this and we give up
+MAX_BACKOFF_SECONDS = 60
+# Interactive clients run inside web requests, so they give up rather than wait longer than this for a token
+INTERACTIVE_MAX_WAIT_SECONDS = 5
+# GetUserProgress takes a comma separated list of game ids, so bound both the count and the URL length
+MAX_PROGRESS_BATCH_SIZE = 50
+MAX_PROGRESS_IDS_LENGTH = 1000
+MAX_PROGRESS_WORKERS = 4
+
+logger = logging.getLogger(__name__)
+
+class RequestFailed(Exception):
+    '''Raised when the API responds with anything other than 200'''
+    def __init__(self, status_code: int):
+        super().__init__(f'Request failed with status code {status_code}')
+        self.status_code = status_code
+
+class Throttled(RequestFailed):
+    '''Raised when the API is still throttling us after retrying, or asks us to wait too long'''
+    pass
 
 class _NotReturned:
     '''For when a value isn't returned by the API'''
@@ -81,7 +113,10 @@ class AchievementsEarnedBetween:
         self.achievements = list()
 
     def add(self, data: list):
-        self.achievements.extend([Achievement(a) for a in data])
+        self.extend([Achievement(a) for a in data])
+
+    def extend(self, achievements: list):
+        self.achievements.extend(achievements)
         # de-dupe by key while maintaining sort order
         seen = set()
         # set.add() returns None and `not None` is True, so it adds it iff it wasn't already in seen
@@ -90,6 +125,14 @@ class AchievementsEarnedBetween:
 
     def get_progress(self, game_id: int, hardcore: bool = True):
         return sum([a.points for a in self.achievements if a.hardcore == hardcore and a.game_id == game_id])
+
+    def between(self, startdate_unix: int, enddate_unix: int):
+        '''
+        Returns a new AchievementsEarnedBetween with only the achievements earned in the given range
+        '''
+        data = AchievementsEarnedBetween()
+        data.extend([a for a in self.achievements if a.date and startdate_unix <= a.date.timestamp() <= enddate_unix])
+        return data
     
 class UserProgress:
     def __init__(self, game_id: int, data: dict):
@@ -112,21 +155,91 @@ class Endpoints:
     GetAchievementsEarnedBetween = f'{_api_url}/API_GetAchievementsEarnedBetween.php'
     GetUserProgress = f'{_api_url}/API_GetUserProgress.php'
 
+# Conservative defaults, they can be overridden with the RA_* settings read in get_rate_limiter
+DEFAULT_RATE_LIMIT = Budget(rate=3, burst=6)
+DEFAULT_ENDPOINT_RATE_LIMITS = {
+    # Each call here is one of several chunks per player, so keep it from starving everything else
+    Endpoints.GetAchievementsEarnedBetween: Budget(rate=1, burst=4),
+}
+DEFAULT_DAILY_QUOTA = 20000
+
+_rate_limiter = None
+
+def get_rate_limiter():
+    '''
+    Returns the RateLimiter shared by every RAclient, creating it from settings on first use
+    '''
+    global _rate_limiter
+    if _rate_limiter is None:
+        base_dir = getattr(settings, 'BASE_DIR', tempfile.gettempdir())
+        _rate_limiter = RateLimiter(
+            getattr(settings, 'RA_RATE_LIMIT_DB', os.path.join(base_dir, 'ra_ratelimit.sqlite3')),
+            getattr(settings, 'RA_RATE_LIMIT', DEFAULT_RATE_LIMIT),
+            getattr(settings, 'RA_ENDPOINT_RATE_LIMITS', DEFAULT_ENDPOINT_RATE_LIMITS),
+            getattr(settings, 'RA_DAILY_QUOTA', DEFAULT_DAILY_QUOTA),
+            getattr(settings, 'RA_BULK_RESERVE', 0.5)
+        )
+    return _rate_limiter
+
+def plan_batches(game_ids: list[int], max_size: int = MAX_PROGRESS_BATCH_SIZE, max_length: int = MAX_PROGRESS_IDS_LENGTH):
+    '''
+    Splits game ids into batches of at most max_size ids whose joined `i=` value is at most max_length characters
+    '''
+    batches = list()
+    batch = list()
+    length = 0
+    for game_id in sorted(set(game_ids)):
+        id_length = len(str(game_id)) + (1 if batch else 0) # +1 for the comma
+        if batch and (len(batch) >= max_size or length + id_length > max_length):
+            batches.append(batch)
+            batch = list()
+            id_length -= 1
+            length = 0
+        batch.append(game_id)
+        length += id_length
+    if batch:
+        batches.append(batch)
+    return batches
+
+def get_retry_after(response: requests.Response, attempt: int):
+    '''
+    Seconds to back off after being throttled, from the Retry-After header if there is one
+    '''
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return BACKOFF_SECONDS * 2 ** attempt
+
 class RAclient:
-    def __init__(self, username: str, api_key: str):
+    def __init__(self, username: str, api_key: str, priority: Priority = Priority.INTERACTIVE, rate_limiter: RateLimiter = None):
         self.base_params = {
             'z': username,
             'y': api_key
         }
+        self.priority = priority
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        # Bulk and command line clients can afford to wait out a throttle
+        self.max_wait = INTERACTIVE_MAX_WAIT_SECONDS if priority == Priority.INTERACTIVE else None
 
     def make_request(self, endpoint: str, params: dict):
-        response = requests.get(endpoint, params | self.base_params)
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                self.rate_limiter.acquire(endpoint, self.priority, self.max_wait)
+            except RateLimited as e:
+                raise Throttled(429) from e
+            response = requests.get(endpoint, params | self.base_params, timeout=REQUEST_TIMEOUT_SECONDS)
 
-        if response.status_code == 200:
-            data = json.loads(response.text)
-            return data
-        else:
-            raise Exception(f'Request failed with status code {response.status_code}')
+            if response.status_code == 200:
+                data = json.loads(response.text)
+                return data
+            elif response.status_code in (429, 503):
+                # Throttled, so make every process back off rather than just this one
+                retry_after = get_retry_after(response, attempt)
+                self.rate_limiter.penalize(endpoint, min(retry_after, MAX_BACKOFF_SECONDS))
+                if attempt == MAX_RETRIES or retry_after > MAX_BACKOFF_SECONDS:
+                    raise Throttled(response.status_code)
+            else:
+                raise RequestFailed(response.status_code)
 
     def get_game(self, game_id: int):
         params = {
@@ -167,17 +280,98 @@ class RAclient:
         return data
     
     def get_user_progress(self, player: str, game_ids: list[int]):
+        '''
+        Gets progress for any number of games, fetching size-bounded batches concurrently.
+        Games the API rejected are missing from the result, so callers should use .get().
+        '''
+        batches = plan_batches(game_ids)
+        progress = dict()
+        if not batches:
+            return progress
+
+        with ThreadPoolExecutor(max_workers=min(MAX_PROGRESS_WORKERS, len(batches))) as executor:
+            for batch_progress in executor.map(lambda batch: self.get_user_progress_batch(player, batch), batches):
+                progress.update(batch_progress)
+        return progress
+
+    def get_user_progress_batch(self, player: str, game_ids: list[int]):
+        '''
+        Gets progress for one batch. If the API rejects the request the batch is split in half and retried,
+        so one bad game id only loses that game rather than the whole batch. Throttling, quota, server and
+        connection errors are raised, since retrying smaller batches would only make them worse.
+        '''
         params = {
             'u': player,
             'i': ",".join((str(game_id) for game_id in game_ids))
         }
-        raw_data = self.make_request(Endpoints.GetUserProgress, params)
+        try:
+            raw_data = self.make_request(Endpoints.GetUserProgress, params)
+        except RequestFailed as e:
+            if isinstance(e, Throttled) or not 400 <= e.status_code < 500:
+                raise
+            if len(game_ids) == 1:
+                logger.warning(f'Could not get progress for {player}, game {game_ids[0]}: {e}')
+                return dict()
+            middle = len(game_ids) // 2
+            return self.get_user_progress_batch(player, game_ids[:middle]) | self.get_user_progress_batch(player, game_ids[middle:])
+
         progress = dict()
+        # The API returns an empty list rather than an object when there's nothing to return
+        if not isinstance(raw_data, dict):
+            return progress
         for key, value in raw_data.items():
-            game_id = int(key)
-            progress[game_id] = UserProgress(game_id, value)
+            try:
+                game_id = int(key)
+            except ValueError:
+                continue
+            if game_id in game_ids and isinstance(value, dict):
+                progress[game_id] = UserProgress(game_id, value)
         return progress
 
+class SharedRAclient(RAclient):
+    '''
+    RAclient that remembers results for its lifetime, so refreshing several groups at once
+    only asks the API about a player once even if they're in more than one group. Thread safe.
+    '''
+    def __init__(self, username: str, api_key: str, priority: Priority = Priority.INTERACTIVE, rate_limiter: RateLimiter = None):
+        super().__init__(username, api_key, priority, rate_limiter)
+        self._lock = threading.Lock()
+        self._player_locks = defaultdict(threading.Lock)
+        # player -> {game_id: UserProgress}, games that couldn't be fetched are left out so they're tried again
+        self._progress = defaultdict(dict)
+        # player -> (start, end, AchievementsEarnedBetween) covering everything fetched so far
+        self._achievements = dict()
+
+    def _player_lock(self, player: str):
+        with self._lock:
+            return self._player_locks[player]
+
+    def get_user_progress(self, player: str, game_ids: list[int]):
+        with self._player_lock(player):
+            cached = self._progress[player]
+            missing = [game_id for game_id in set(game_ids) if game_id not in cached]
+            if missing:
+                cached.update(super().get_user_progress(player, missing))
+            return {game_id: cached[game_id] for game_id in game_ids if game_id in cached}
+
+    def get_achievements_earned_between(self, player: str, startdate_unix: int, enddate_unix: int):
+        enddate_unix = min(enddate_unix, int(datetime.utcnow().timestamp()))
+        with self._player_lock(player):
+            if player not in self._achievements:
+                data = super().get_achievements_earned_between(player, startdate_unix, enddate_unix)
+                self._achievements[player] = (startdate_unix, enddate_unix, data)
+            else:
+                # Only fetch the parts of the range that haven't been fetched yet
+                start, end, data = self._achievements[player]
+                if startdate_unix < start:
+                    data.extend(super().get_achievements_earned_between(player, startdate_unix, start - 1).achievements)
+                    start = startdate_unix
+                if enddate_unix > end:
+                    data.extend(super().get_achievements_earned_between(player, end + 1, enddate_unix).achievements)
+                    end = enddate_unix
+                self._achievements[player] = (start, end, data)
+            return data.between(startdate_unix, enddate_unix)
+
 def get_login():
     username = Setting.objects.filter(name='username')[0].value
     api_key = Setting.objects.filter(name='api_key')[0].value
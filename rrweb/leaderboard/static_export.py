@@ -0,0 +1,136 @@
+import gzip
+import json
+import os
+import tempfile
+from pathlib import Path
+from django.template import loader
+from leaderboard.models import Challenge, Group
+from leaderboard.views import get_leaderboard_context, get_max_challenge_id, get_last_run
+
+try:
+    import brotli
+except ImportError: # brotli is optional, we just skip the .br files without it
+    brotli = None
+
+INDEX_FILE = 'index.html'
+DATA_FILE = 'leaderboard.json'
+CHALLENGES_FILE = 'challenges.json'
+ARCHIVE_DIR = 'challenges'
+
+def write_atomic(path: Path, content: bytes):
+    '''
+    Writes content to a temp file next to path and moves it into place, so the web server never serves a partial file.
+    Returns False without touching the file if the content hasn't changed.
+    '''
+    try:
+        if path.read_bytes() == content:
+            return False
+    except FileNotFoundError:
+        pass
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return True
+
+def write_precompressed(path: Path, content: bytes):
+    '''
+    Writes the file along with .gz and .br versions for nginx's gzip_static/brotli_static.
+    Every variant goes through write_atomic, so stale or missing ones are fixed and unchanged ones are left alone.
+    The compressed files are written first, so a crash part way through can't leave them older than the plain file.
+    '''
+    # mtime=0 keeps the gzip output stable between runs
+    write_atomic(path.with_name(path.name + '.gz'), gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli:
+        write_atomic(path.with_name(path.name + '.br'), brotli.compress(content, mode=brotli.MODE_TEXT))
+    write_atomic(path, content)
+
+def get_leaderboard_data(challenge: Challenge, context: dict, last_run: str = None):
+    retro_game_ids = {game.pk: game.retro_game_id for game in context['games']}
+    return {
+        'challenge': {
+            'id': challenge.id,
+            'start': challenge.start,
+            'end': challenge.end,
+            'group': challenge.group.slug if challenge.group_id else None
+        },
+        'last_updated': last_run,
+        'games': [{
+            'retro_game_id': game.retro_game_id,
+            'name': game.name,
+            'game_icon': game.game_icon
+        } for game in context['games']],
+        'players': [{
+            'name': player.name,
+            'total_score': sum([score.score for score in scores]),
+            'scores': {retro_game_ids[score.game_id]: score.score for score in scores}
+        } for player, scores in context['sorted_grouped_scores']]
+    }
+
+def render_challenge(directory: Path, challenge: Challenge, is_archive: bool, last_run: str = None):
+    context = get_leaderboard_context(challenge.id)
+    template = loader.get_template('leaderboard/index.html')
+    html = template.render(context | {
+        'last_run': last_run,
+        'can_be_run': False,
+        'is_static': True,
+        'is_archive': is_archive,
+        'challenge': challenge,
+        'group': challenge.group
+    })
+    data = get_leaderboard_data(challenge, context, last_run)
+
+    write_precompressed(directory / INDEX_FILE, html.encode('utf-8'))
+    write_precompressed(directory / DATA_FILE, json.dumps(data).encode('utf-8'))
+
+def render_group(output_dir: Path, group: Group = None, rerender_archive: bool = False):
+    '''
+    Renders the group's current leaderboard to output_dir and each of its challenges to output_dir/challenges/<id>/.
+    Past challenges don't change, so they're only rendered if missing unless rerender_archive is set.
+    '''
+    current_id = get_max_challenge_id(group)
+    last_run = get_last_run(group).value
+    challenges = Challenge.objects.filter(group=group).select_related('group').order_by('-id')
+    rendered = list()
+
+    for challenge in challenges:
+        directory = output_dir / ARCHIVE_DIR / str(challenge.id)
+        is_current = challenge.id == current_id
+        if is_current or rerender_archive or not (directory / INDEX_FILE).exists():
+            render_challenge(directory, challenge, not is_current, last_run if is_current else None)
+            rendered.append(challenge.id)
+        if is_current:
+            render_challenge(output_dir, challenge, False, last_run)
+
+    challenge_list = [{
+        'id': challenge.id,
+        'start': challenge.start,
+        'end': challenge.end,
+        'path': f'{ARCHIVE_DIR}/{challenge.id}/'
+    } for challenge in challenges]
+    write_precompressed(output_dir / CHALLENGES_FILE, json.dumps(challenge_list).encode('utf-8'))
+
+    return rendered
+
+def render_static_leaderboard(output_dir: str, rerender_archive: bool = False, groups: list = None):
+    '''
+    Renders the challenges without a group to output_dir and each group to output_dir/<group slug>/.
+    groups defaults to every group, with None standing for the challenges without one.
+    Returns the list of challenge ids that were rendered.
+    '''
+    if groups is None:
+        groups = [None] + list(Group.objects.order_by('slug'))
+    rendered = list()
+    for group in groups:
+        directory = Path(output_dir) / group.slug if group else Path(output_dir)
+        rendered += render_group(directory, group, rerender_archive)
+    return rendered
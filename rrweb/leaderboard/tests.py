@@ -1,3 +1,493 @@
-from django.test import TestCase
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from io import StringIO
+from pathlib import Path
+from datetime import datetime, timezone
+from unittest import mock
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.test import RequestFactory, SimpleTestCase, TestCase
 
-# Create your tests here.
+from .ratelimit import RateLimiter, RateLimited, Budget, Priority, QuotaExceeded
+from . import admin, retro, static_export, views
+from .models import Achievement, Challenge, Game, Group, Player, PlayerScore, Setting
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_burst_then_wait(self):
+        limiter = RateLimiter(self.path, Budget(rate=1, burst=2))
+        self.assertEqual(limiter.try_acquire('a'), 0)
+        self.assertEqual(limiter.try_acquire('a'), 0)
+        self.assertGreater(limiter.try_acquire('a'), 0)
+
+    def test_endpoint_budget(self):
+        limiter = RateLimiter(self.path, Budget(rate=1, burst=10), {'slow': Budget(rate=1, burst=1)})
+        self.assertEqual(limiter.try_acquire('slow'), 0)
+        self.assertGreater(limiter.try_acquire('slow'), 0)
+        self.assertEqual(limiter.try_acquire('other'), 0)
+
+    def test_state_is_shared(self):
+        RateLimiter(self.path, Budget(rate=1, burst=1)).try_acquire('a')
+        self.assertGreater(RateLimiter(self.path, Budget(rate=1, burst=1)).try_acquire('a'), 0)
+
+    def test_bulk_reserve(self):
+        limiter = RateLimiter(self.path, Budget(rate=1, burst=4), bulk_reserve=0.5)
+        # Bulk needs 1 token plus half the bucket left over
+        self.assertEqual(limiter.try_acquire('a', Priority.BULK), 0)
+        self.assertEqual(limiter.try_acquire('a', Priority.BULK), 0)
+        self.assertGreater(limiter.try_acquire('a', Priority.BULK), 0)
+        # The reserve is still there for interactive requests
+        self.assertEqual(limiter.try_acquire('a', Priority.INTERACTIVE), 0)
+        self.assertEqual(limiter.try_acquire('a', Priority.INTERACTIVE), 0)
+
+    def test_quota_exhausted(self):
+        limiter = RateLimiter(self.path, Budget(rate=100, burst=100), daily_quota=4, bulk_reserve=0.5)
+        limiter.try_acquire('a', Priority.BULK)
+        limiter.try_acquire('a', Priority.BULK)
+        with self.assertRaises(QuotaExceeded):
+            limiter.try_acquire('a', Priority.BULK)
+        limiter.try_acquire('a')
+        limiter.try_acquire('a')
+        self.assertEqual(limiter.get_quota_used(), 4)
+        with self.assertRaises(QuotaExceeded):
+            limiter.try_acquire('a')
+
+    def test_waiting_does_not_use_quota(self):
+        limiter = RateLimiter(self.path, Budget(rate=1, burst=1), daily_quota=10)
+        limiter.try_acquire('a')
+        limiter.try_acquire('a')
+        self.assertEqual(limiter.get_quota_used(), 1)
+
+    def test_penalize(self):
+        limiter = RateLimiter(self.path, Budget(rate=100, burst=100))
+        limiter.penalize('a', 30)
+        self.assertGreater(limiter.try_acquire('a'), 29)
+        self.assertGreater(limiter.try_acquire('other'), 29)
+
+    def test_acquire_max_wait(self):
+        limiter = RateLimiter(self.path, Budget(rate=100, burst=100))
+        limiter.penalize('a', 30)
+        with mock.patch('leaderboard.ratelimit.time.sleep') as sleep:
+            with self.assertRaises(RateLimited):
+                limiter.acquire('a', max_wait=5)
+        sleep.assert_not_called()
+
+def make_response(status_code: int, text: str = '{}', headers: dict = None):
+    response = mock.Mock(status_code=status_code, text=text)
+    response.headers = headers or dict()
+    return response
+
+class MakeRequestTests(SimpleTestCase):
+    def setUp(self):
+        self.limiter = mock.Mock(spec=RateLimiter)
+        self.client = retro.RAclient('user', 'key', rate_limiter=self.limiter)
+
+    @mock.patch('leaderboard.retro.requests.get')
+    def test_retries_after_throttle(self, get):
+        get.side_effect = [make_response(429, headers={'Retry-After': '2'}), make_response(200, '{"a": 1}')]
+        self.assertEqual(self.client.make_request('endpoint', dict()), {'a': 1})
+        self.limiter.penalize.assert_called_once_with('endpoint', 2.0)
+
+    @mock.patch('leaderboard.retro.requests.get')
+    def test_last_throttle_penalizes(self, get):
+        get.return_value = make_response(429, headers={'Retry-After': '1'})
+        with self.assertRaises(retro.Throttled):
+            self.client.make_request('endpoint', dict())
+        self.assertEqual(self.limiter.penalize.call_count, retro.MAX_RETRIES + 1)
+
+    @mock.patch('leaderboard.retro.requests.get')
+    def test_long_retry_after_is_capped(self, get):
+        get.return_value = make_response(429, headers={'Retry-After': '7200'})
+        with self.assertRaises(retro.Throttled):
+            self.client.make_request('endpoint', dict())
+        self.limiter.penalize.assert_called_once_with('endpoint', retro.MAX_BACKOFF_SECONDS)
+
+    @mock.patch('leaderboard.retro.requests.get')
+    def test_interactive_gives_up_waiting(self, get):
+        self.limiter.acquire.side_effect = RateLimited()
+        with self.assertRaises(retro.Throttled):
+            self.client.make_request('endpoint', dict())
+        self.limiter.acquire.assert_called_once_with('endpoint', Priority.INTERACTIVE, retro.INTERACTIVE_MAX_WAIT_SECONDS)
+        get.assert_not_called()
+
+    def test_bulk_waits(self):
+        client = retro.RAclient('user', 'key', Priority.BULK, rate_limiter=self.limiter)
+        self.assertIsNone(client.max_wait)
+
+    @mock.patch('leaderboard.retro.requests.get')
+    def test_other_errors_are_not_retried(self, get):
+        get.return_value = make_response(500)
+        with self.assertRaises(retro.RequestFailed) as context:
+            self.client.make_request('endpoint', dict())
+        self.assertEqual(context.exception.status_code, 500)
+        self.assertEqual(get.call_count, 1)
+
+class PlanBatchesTests(SimpleTestCase):
+    def test_sorted_and_deduplicated(self):
+        self.assertEqual(retro.plan_batches([3, 1, 2, 2], max_size=2), [[1, 2], [3]])
+
+    def test_empty(self):
+        self.assertEqual(retro.plan_batches([]), [])
+
+    def test_length_bound(self):
+        game_ids = list(range(10000, 10100))
+        batches = retro.plan_batches(game_ids, max_size=50, max_length=30)
+        self.assertTrue(all(len(','.join(str(game_id) for game_id in batch)) <= 30 for batch in batches))
+        self.assertEqual(sum(batches, []), game_ids)
+
+class FakeProgressClient(retro.RAclient):
+    '''Answers GetUserProgress from memory, failing for the given game ids'''
+    def __init__(self, fail_ids: set = None, status_code: int = 400):
+        super().__init__('user', 'key', rate_limiter=mock.Mock(spec=RateLimiter))
+        self.fail_ids = fail_ids or set()
+        self.status_code = status_code
+        self.requests = list()
+
+    def make_request(self, endpoint: str, params: dict):
+        game_ids = [int(game_id) for game_id in params['i'].split(',')]
+        self.requests.append(game_ids)
+        if self.fail_ids.intersection(game_ids):
+            raise retro.RequestFailed(self.status_code)
+        return {str(game_id): {'ScoreAchievedHardcore': game_id * 10} for game_id in game_ids}
+
+class GetUserProgressTests(SimpleTestCase):
+    def test_merges_batches(self):
+        client = FakeProgressClient()
+        progress = client.get_user_progress('player', list(range(1, 121)))
+        self.assertEqual(len(client.requests), 3)
+        self.assertEqual(sorted(progress), list(range(1, 121)))
+        self.assertEqual(progress[7].score_achieved_hardcore, 70)
+
+    def test_rejected_id_is_left_out(self):
+        client = FakeProgressClient(fail_ids={3})
+        with self.assertLogs('leaderboard.retro', 'WARNING'):
+            progress = client.get_user_progress('player', [1, 2, 3, 4])
+        self.assertEqual(sorted(progress), [1, 2, 4])
+
+    def test_server_errors_are_raised(self):
+        client = FakeProgressClient(fail_ids={3}, status_code=500)
+        with self.assertRaises(retro.RequestFailed):
+            client.get_user_progress('player', [1, 2, 3, 4])
+        self.assertEqual(len(client.requests), 1)
+
+    def test_throttling_is_raised(self):
+        client = FakeProgressClient()
+        client.make_request = mock.Mock(side_effect=retro.Throttled(429))
+        with self.assertRaises(retro.Throttled):
+            client.get_user_progress('player', [1, 2, 3, 4])
+        self.assertEqual(client.make_request.call_count, 1)
+
+    def test_quota_is_raised(self):
+        client = FakeProgressClient()
+        client.make_request = mock.Mock(side_effect=QuotaExceeded())
+        with self.assertRaises(QuotaExceeded):
+            client.get_user_progress('player', [1, 2])
+
+    def test_partial_response(self):
+        client = FakeProgressClient()
+        client.make_request = mock.Mock(return_value={'1': {'ScoreAchievedHardcore': 5}, '99': {}, 'x': {}})
+        progress = client.get_user_progress('player', [1, 2])
+        self.assertEqual(list(progress), [1])
+
+def make_achievement(achievement_id: int, date: datetime, game_id: int = 1):
+    return {
+        'AchievementID': achievement_id,
+        'Date': date.strftime('%Y-%m-%d %H:%M:%S'),
+        'HardcoreMode': 1,
+        'Title': f'Achievement {achievement_id}',
+        'Description': '',
+        'GameTitle': 'Game',
+        'Points': 5,
+        'GameID': game_id
+    }
+
+class SharedRAclientTests(SimpleTestCase):
+    def setUp(self):
+        self.client = retro.SharedRAclient('user', 'key', rate_limiter=mock.Mock(spec=RateLimiter))
+        # One achievement a day through January 2023
+        self.achievements = [make_achievement(day, datetime(2023, 1, day)) for day in range(1, 32)]
+        self.fetched = list()
+
+    def fake_fetch(self, player: str, startdate_unix: int, enddate_unix: int):
+        self.fetched.append((startdate_unix, enddate_unix))
+        data = retro.AchievementsEarnedBetween()
+        data.add([a for a in self.achievements
+                  if startdate_unix <= retro.get_utc_date_from_response_string(a['Date']).timestamp() <= enddate_unix])
+        return data
+
+    def timestamp(self, day: int):
+        return int(retro.get_utc_date_from_response_string(f'2023-01-{day:02} 00:00:00').timestamp())
+
+    def get_ids(self, start_day: int, end_day: int):
+        data = self.client.get_achievements_earned_between('player', self.timestamp(start_day), self.timestamp(end_day))
+        return sorted(a.id for a in data.achievements)
+
+    @mock.patch('leaderboard.retro.RAclient.get_achievements_earned_between')
+    def test_covered_range_is_not_fetched_again(self, fetch):
+        fetch.side_effect = self.fake_fetch
+        self.assertEqual(self.get_ids(1, 20), list(range(1, 21)))
+        self.assertEqual(self.get_ids(5, 10), list(range(5, 11)))
+        self.assertEqual(len(self.fetched), 1)
+
+    @mock.patch('leaderboard.retro.RAclient.get_achievements_earned_between')
+    def test_only_missing_parts_are_fetched(self, fetch):
+        fetch.side_effect = self.fake_fetch
+        self.get_ids(10, 20)
+        self.assertEqual(self.get_ids(5, 25), list(range(5, 26)))
+        self.assertEqual(self.fetched, [
+            (self.timestamp(10), self.timestamp(20)),
+            (self.timestamp(5), self.timestamp(10) - 1),
+            (self.timestamp(20) + 1, self.timestamp(25))
+        ])
+
+    @mock.patch('leaderboard.retro.RAclient.get_achievements_earned_between')
+    def test_players_are_cached_separately(self, fetch):
+        fetch.side_effect = self.fake_fetch
+        self.client.get_achievements_earned_between('a', self.timestamp(1), self.timestamp(5))
+        self.client.get_achievements_earned_between('b', self.timestamp(1), self.timestamp(5))
+        self.assertEqual(len(self.fetched), 2)
+
+    @mock.patch('leaderboard.retro.RAclient.get_user_progress')
+    def test_progress_is_only_fetched_for_new_games(self, fetch):
+        fetch.side_effect = lambda player, game_ids: {game_id: retro.UserProgress(game_id, dict()) for game_id in game_ids if game_id != 3}
+        self.assertEqual(sorted(self.client.get_user_progress('player', [1, 2, 3])), [1, 2])
+        self.assertEqual(sorted(self.client.get_user_progress('player', [2, 3, 4])), [2, 4])
+        # 3 failed the first time, so it's asked for again
+        self.assertEqual(sorted(fetch.call_args_list[1].args[1]), [3, 4])
+
+class GroupTests(TestCase):
+    def setUp(self):
+        Setting.objects.create(name='last_run', value='2000-01-01 00:00:00')
+        self.group = Group.objects.create(name='Bracket A', slug='bracket-a')
+
+    def test_reserved_slugs(self):
+        for slug in ('update', 'refresh_games', 'challenges'):
+            with self.assertRaises(ValidationError):
+                Group(name='Bad', slug=slug).full_clean()
+        Group(name='Fine', slug='bracket-b').full_clean()
+
+    def test_games_can_be_shared_between_challenges(self):
+        other_group = Group.objects.create(name='Bracket B', slug='bracket-b')
+        for group in (self.group, other_group):
+            challenge = Challenge.objects.create(start=0, end=1, group=group)
+            Game.objects.create(retro_game_id=1, challenge=challenge, name='Game')
+        self.assertEqual(Game.objects.filter(retro_game_id=1).count(), 2)
+
+    def test_update_without_challenges(self):
+        response = self.client.get('/leaderboard/bracket-a/update')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Setting.objects.filter(name='last_run_bracket-a').exclude(value='2000-01-01 00:00:00').exists())
+
+class WriteStaticTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.path = self.directory / 'index.html'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unchanged_content_is_not_rewritten(self):
+        self.assertTrue(static_export.write_atomic(self.path, b'board'))
+        os.utime(self.path, ns=(0, 0))
+        self.assertFalse(static_export.write_atomic(self.path, b'board'))
+        self.assertEqual(self.path.stat().st_mtime_ns, 0)
+
+    def test_changed_content_is_replaced(self):
+        static_export.write_atomic(self.path, b'old')
+        self.assertTrue(static_export.write_atomic(self.path, b'new'))
+        self.assertEqual(self.path.read_bytes(), b'new')
+        self.assertEqual([p.name for p in self.directory.iterdir()], ['index.html'])
+
+    def test_missing_variant_is_written(self):
+        self.path.write_bytes(b'board')
+        static_export.write_precompressed(self.path, b'board')
+        self.assertEqual(gzip.decompress((self.directory / 'index.html.gz').read_bytes()), b'board')
+
+    def test_stale_variant_is_rewritten(self):
+        # e.g. a run that crashed after replacing the plain file but before its .gz
+        self.path.write_bytes(b'new')
+        (self.directory / 'index.html.gz').write_bytes(gzip.compress(b'old'))
+        static_export.write_precompressed(self.path, b'new')
+        self.assertEqual(gzip.decompress((self.directory / 'index.html.gz').read_bytes()), b'new')
+
+class RenderStaticTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        Setting.objects.create(name='last_run', value='2023-01-02 03:04:05')
+        player = Player.objects.create(name='alice')
+        for retro_game_id in (10, 20):
+            challenge = Challenge.objects.create(start=0, end=1)
+            game = Game.objects.create(retro_game_id=retro_game_id, challenge=challenge, name=f'Game {retro_game_id}')
+            PlayerScore.objects.create(player=player, game=game, score=retro_game_id)
+        self.current = challenge
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def render(self, *args):
+        out = StringIO()
+        call_command('render_static', '--output-dir', self.directory, *args, stdout=out)
+        return out.getvalue()
+
+    def test_archive_is_only_rendered_once(self):
+        self.assertIn(f'{self.current.id}, {self.current.id - 1}', self.render())
+        self.assertIn(f'challenges {self.current.id} to', self.render())
+        self.assertIn(f'{self.current.id}, {self.current.id - 1}', self.render('--rerender-archive'))
+
+    def test_leaderboard_json(self):
+        self.render()
+        data = json.loads((Path(self.directory) / 'leaderboard.json').read_text())
+        self.assertEqual(data, {
+            'challenge': {'id': self.current.id, 'start': 0, 'end': 1, 'group': None},
+            'last_updated': '2023-01-02 03:04:05',
+            'games': [{'retro_game_id': 20, 'name': 'Game 20', 'game_icon': None}],
+            'players': [{'name': 'alice', 'total_score': 20, 'scores': {'20': 20}}]
+        })
+        archive = Path(self.directory) / 'challenges' / str(self.current.id - 1) / 'leaderboard.json'
+        self.assertEqual(json.loads(archive.read_text())['players'][0]['scores'], {'10': 10})
+        self.assertTrue((Path(self.directory) / 'index.html.gz').exists())
+
+class EstimatedCountPaginatorTests(TestCase):
+    def setUp(self):
+        for name in ('alice', 'bob', 'carol'):
+            Player.objects.create(name=name, is_active=name != 'carol')
+
+    @mock.patch('leaderboard.admin.get_estimated_count', return_value=10 ** 7)
+    def test_unfiltered_uses_estimate(self, get_estimated_count):
+        self.assertEqual(admin.EstimatedCountPaginator(Player.objects.order_by('pk'), 10).count, 10 ** 7)
+
+    @mock.patch('leaderboard.admin.get_estimated_count', return_value=10 ** 7)
+    def test_filtered_counts(self, get_estimated_count):
+        self.assertEqual(admin.EstimatedCountPaginator(Player.objects.filter(is_active=True).order_by('pk'), 10).count, 2)
+        get_estimated_count.assert_not_called()
+
+    @mock.patch('leaderboard.admin.get_estimated_count', return_value=10)
+    def test_small_tables_count(self, get_estimated_count):
+        self.assertEqual(admin.EstimatedCountPaginator(Player.objects.order_by('pk'), 10).count, 3)
+
+    def test_sqlite_counts(self):
+        self.assertIsNone(admin.get_estimated_count(Player._meta.db_table))
+        self.assertEqual(admin.EstimatedCountPaginator(Player.objects.order_by('pk'), 10).count, 3)
+
+class AdminTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.user)
+        self.alice = Player.objects.create(name='alice')
+        self.bob = Player.objects.create(name='bob')
+        self.challenge = Challenge.objects.create(start=0, end=1)
+        self.game = Game.objects.create(retro_game_id=1, challenge=self.challenge, name='Game')
+
+    def run_action(self, action: str, players: list):
+        return self.client.post('/admin/leaderboard/player/', {
+            'action': action,
+            '_selected_action': [player.pk for player in players]
+        })
+
+    def test_deactivate_and_activate(self):
+        self.run_action('deactivate_players', [self.alice, self.bob])
+        self.assertFalse(Player.objects.filter(is_active=True).exists())
+        self.run_action('activate_players', [self.alice])
+        self.assertEqual(list(Player.objects.filter(is_active=True)), [self.alice])
+
+    def test_resync_needs_one_player(self):
+        self.run_action('resync_player', [self.alice, self.bob])
+        self.assertFalse(Setting.objects.filter(name__startswith=views.RESYNC_SETTING_PREFIX).exists())
+        self.run_action('resync_player', [self.alice])
+        self.assertEqual(list(Setting.objects.filter(name__startswith=views.RESYNC_SETTING_PREFIX).values_list('value', flat=True)), ['alice'])
+
+    def add_rows(self, count: int):
+        start = Achievement.objects.count()
+        for i in range(start, start + count):
+            player = Player.objects.create(name=f'player{i}')
+            game = Game.objects.create(retro_game_id=1000 + i, challenge=self.challenge, name=f'Game {i}')
+            PlayerScore.objects.create(player=player, game=game, score=i)
+            Achievement.objects.create(player=player, game=game, achievement_id=i, title='', description='',
+                                       date=datetime(2023, 1, 1, tzinfo=timezone.utc), hardcore=True, points=5)
+
+    def count_queries(self, url: str):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_changelist_queries_are_constant(self):
+        for url in ('/admin/leaderboard/achievement/', '/admin/leaderboard/playerscore/'):
+            self.add_rows(3)
+            few = self.count_queries(url)
+            self.add_rows(30)
+            self.assertEqual(self.count_queries(url), few)
+
+    def test_search_filters_on_player_id(self):
+        self.add_rows(3)
+        model_admin = site._registry[Achievement]
+        request = RequestFactory().get('/')
+        queryset, may_have_duplicates = model_admin.get_search_results(request, Achievement.objects.all(), 'player1')
+        self.assertEqual([a.player.name for a in queryset], ['player1'])
+        self.assertIn('"player_id" =', str(queryset.query))
+        self.assertNotIn('leaderboard_player', str(queryset.query))
+        queryset, may_have_duplicates = model_admin.get_search_results(request, Achievement.objects.all(), 'nobody')
+        self.assertFalse(queryset.exists())
+
+class FakeRefreshClient:
+    def __init__(self, achievements: list):
+        self.achievements = achievements
+
+    def get_user_progress(self, player: str, game_ids: list):
+        return {game_id: retro.UserProgress(game_id, {'ScoreAchievedHardcore': 10}) for game_id in game_ids}
+
+    def get_achievements_earned_between(self, player: str, startdate_unix: int, enddate_unix: int):
+        data = retro.AchievementsEarnedBetween()
+        data.add(self.achievements)
+        return data.between(startdate_unix, enddate_unix)
+
+class RefreshTests(TestCase):
+    def setUp(self):
+        self.player = Player.objects.create(name='alice')
+        start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        self.challenge = Challenge.objects.create(start=int(start.timestamp()), end=int(start.timestamp()) + 30 * 86400)
+        self.game = Game.objects.create(retro_game_id=1, challenge=self.challenge, name='Game')
+        self.client = FakeRefreshClient([make_achievement(1, datetime(2023, 1, 2)), make_achievement(2, datetime(2023, 1, 3))])
+
+    def test_force_replaces_achievements(self):
+        views.refresh_leaderboard_smart(self.challenge.id, client=self.client)
+        for i in range(2):
+            views.refresh_leaderboard_smart(self.challenge.id, players=[self.player], force=True, client=self.client)
+        self.assertEqual(sorted(Achievement.objects.values_list('achievement_id', flat=True)), [1, 2])
+        self.assertEqual(PlayerScore.objects.get(player=self.player).score, 10)
+
+    def test_force_keeps_other_challenges(self):
+        other = Challenge.objects.create(start=0, end=1)
+        other_game = Game.objects.create(retro_game_id=1, challenge=other, name='Game')
+        Achievement.objects.create(player=self.player, game=other_game, achievement_id=9, title='', description='',
+                                   date=datetime(2022, 1, 1, tzinfo=timezone.utc), hardcore=True, points=5)
+        views.refresh_leaderboard_smart(self.challenge.id, players=[self.player], force=True, client=self.client)
+        self.assertTrue(Achievement.objects.filter(game=other_game).exists())
+
+    def test_already_stored_achievements_are_skipped(self):
+        views.refresh_leaderboard_smart(self.challenge.id, client=self.client)
+        # As if another refresh stored them while this one was fetching
+        with mock.patch('leaderboard.views.get_latest_achievement_date', side_effect=[None, Achievement.objects.latest('date').date]):
+            PlayerScore.objects.all().delete()
+            views.refresh_leaderboard_smart(self.challenge.id, client=self.client)
+        self.assertEqual(Achievement.objects.count(), 2)
+
+    def test_queued_resync(self):
+        views.queue_resync(self.player)
+        self.assertEqual(views.run_queued_resyncs(self.client), ['alice'])
+        self.assertEqual(Achievement.objects.count(), 2)
+        self.assertFalse(Setting.objects.filter(name__startswith=views.RESYNC_SETTING_PREFIX).exists())
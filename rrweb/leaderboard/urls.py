@@ -5,5 +5,7 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('update', views.update),
-    path('refresh_games', views.refresh_games)
+    path('refresh_games', views.refresh_games),
+    path('<slug:group_slug>/', views.index, name='group_index'),
+    path('<slug:group_slug>/update', views.update, name='group_update')
 ]
\ No newline at end of file
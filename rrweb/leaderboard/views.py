@@ -3,28 +3,39 @@ import pytz
 from itertools import groupby
 from datetime import datetime, timedelta
 from humanize import naturaltime
-from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import HttpResponse, Http404
 from django.template import loader
+from django.conf import settings
 from django.utils import timezone
 from django.core.exceptions import PermissionDenied
 from django.db.models import Max, Sum
 from django.db import transaction
 from django.contrib.admin.views.decorators import staff_member_required
-from leaderboard.models import Player, Game, Challenge, PlayerScore, Setting, Achievement
+from leaderboard.models import Player, Game, Challenge, PlayerScore, Setting, Achievement, Group
 from .retro import RAclient
+from .ratelimit import Priority
 
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 MIN_UPDATE_INTERVAL_SECONDS = 60 * 10
 
-def is_update_allowed():
-    last_run = Setting.objects.filter(name='last_run')[0]
+def get_last_run(group: Group = None):
+    '''
+    The last_run Setting, each group has its own so they can be updated independently
+    '''
+    if not group:
+        return Setting.objects.filter(name='last_run')[0]
+    last_run, created = Setting.objects.get_or_create(name=f'last_run_{group.slug}', defaults={'value': '2000-01-01 00:00:00'})
+    return last_run
+
+def is_update_allowed(group: Group = None):
+    last_run = get_last_run(group)
     last_run_date = pytz.utc.localize(datetime.strptime(last_run.value, DATE_FORMAT))
     utc_now = pytz.utc.localize(datetime.utcnow())
 
     can_be_run = False
 
-    if (utc_now - last_run_date).seconds > MIN_UPDATE_INTERVAL_SECONDS:
+    if (utc_now - last_run_date).total_seconds() > MIN_UPDATE_INTERVAL_SECONDS:
         can_be_run = True
 
     return (can_be_run, last_run, naturaltime(last_run_date, when=utc_now))
@@ -49,83 +60,157 @@ class LeaderBoardEntry():
         self.total_score = total_score
         self.game_scores = game_scores
 
-def index(request):
-    can_be_run, last_run, natural_time = is_update_allowed()
-
-    challenge_id = get_max_challenge_id()
-
+def get_leaderboard_context(challenge_id: int):
+    challenge = Challenge.objects.get(pk=challenge_id)
     games = Game.objects.filter(challenge__id=challenge_id).order_by('retro_game_id')
-    scores = PlayerScore.objects.filter(game__challenge__id=challenge_id, player__is_active=True).order_by('player_id', 'game__retro_game_id').select_related('player')
+    scores = PlayerScore.objects.filter(game__challenge__id=challenge_id, player__in=challenge.get_players()).order_by('player_id', 'game__retro_game_id').select_related('player')
 
     grouped_scores = [(key, list(group)) for key, group in groupby(scores, key=lambda x: x.player)]
     sorted_grouped_scores = sorted(grouped_scores, key=lambda x: sum([score.score for score in x[1]]), reverse=True)
 
-    template = loader.get_template('leaderboard/index.html')
-    context = {
+    return {
         'games': games,
-        'sorted_grouped_scores': sorted_grouped_scores,
+        'sorted_grouped_scores': sorted_grouped_scores
+    }
+
+def get_group_or_404(group_slug: str = None):
+    return get_object_or_404(Group, slug=group_slug) if group_slug else None
+
+def get_group_url(group: Group = None):
+    return f'/leaderboard/{group.slug}/' if group else '/leaderboard/'
+
+def index(request, group_slug: str = None):
+    group = get_group_or_404(group_slug)
+    can_be_run, last_run, natural_time = is_update_allowed(group)
+
+    challenge_id = get_max_challenge_id(group)
+    if challenge_id is None:
+        raise Http404('No challenges yet')
+
+    template = loader.get_template('leaderboard/index.html')
+    context = get_leaderboard_context(challenge_id) | {
+        'group': group,
+        'update_url': f'{get_group_url(group)}update',
         'last_run': natural_time,
         'can_be_run': can_be_run
     }
     return HttpResponse(template.render(context, request))
 
-def update(request):
-    can_be_run, last_run, natural_time = is_update_allowed()
+def update(request, group_slug: str = None):
+    group = get_group_or_404(group_slug)
+    can_be_run, last_run, natural_time = is_update_allowed(group)
+
+    challenge_id = get_max_challenge_id(group)
+    if challenge_id is None:
+        raise Http404('No challenges yet')
 
     if not can_be_run:
         raise PermissionDenied()
     else:
+        previous_run = last_run.value
         last_run.value = timezone.now().strftime(DATE_FORMAT)
         last_run.save()
-        challenge_id = get_max_challenge_id()
-        refresh_leaderboard_smart(challenge_id)
-        return redirect('/leaderboard', permanent=False)
+        try:
+            refresh_leaderboard_smart(challenge_id)
+        except Exception:
+            # Don't show the board as freshly updated when the refresh was rolled back
+            last_run.value = previous_run
+            last_run.save()
+            raise
+        if getattr(settings, 'LEADERBOARD_STATIC_ROOT', None):
+            # Imported here since static_export depends on this module
+            from .static_export import render_static_leaderboard
+            render_static_leaderboard(settings.LEADERBOARD_STATIC_ROOT, groups=[group])
+        return redirect(get_group_url(group), permanent=False)
     
-def get_max_challenge_id():
-    challenge_id = Challenge.objects.aggregate(Max('id'))['id__max']
+def get_max_challenge_id(group: Group = None):
+    '''
+    The latest challenge of the group, or of the challenges without a group
+    '''
+    challenge_id = Challenge.objects.filter(group=group).aggregate(Max('id'))['id__max']
     return challenge_id
 
+def get_current_challenges():
+    '''
+    The latest challenge of every group, plus the latest one without a group
+    '''
+    challenge_ids = Challenge.objects.values('group').annotate(max_id=Max('id')).values_list('max_id', flat=True)
+    return Challenge.objects.filter(id__in=list(challenge_ids)).select_related('group').order_by('id')
+
+def get_latest_achievement_date(player: Player, challenge_id: int):
+    return Achievement.objects.filter(player_id=player.pk, game__challenge_id=challenge_id).aggregate(Max('date'))['date__max']
+
 @transaction.atomic
-def refresh_leaderboard_smart(challenge_id: int):
+def refresh_leaderboard_smart(challenge_id: int, players: list = None, force: bool = False, client: RAclient = None):
+    '''
+    Refreshes scores for the challenge. Only players whose progress changed are updated unless force is set,
+    in which case their achievements for the challenge are dropped and fetched again from the challenge start.
+    Pass a SharedRAclient as client to reuse API results across several refreshes.
+    '''
     challenge = Challenge.objects.get(pk=challenge_id)
     games = Game.objects.filter(challenge__id=challenge.pk).order_by('retro_game_id')
-    players = Player.objects.filter(is_active=True)
+    if players is None:
+        players = challenge.get_players()
     player_scores = PlayerScore.objects.filter(game__challenge__id=challenge_id).select_related('game')
 
     players_needing_update = list()
     # Store individual player progress for updating PlayerScores later
     players_progress = dict()
 
-    username, api_key = get_login()
-    client = RAclient(username, api_key)
+    if not client:
+        username, api_key = get_login()
+        client = RAclient(username, api_key)
 
     for player in players:
         user_progress = client.get_user_progress(player.name, [game.retro_game_id for game in games] )
         players_progress[player.name] = user_progress
 
+        if force:
+            players_needing_update.append(player)
+            continue
+
         for game in games:
-            game_progress = user_progress[game.retro_game_id]
+            game_progress = user_progress.get(game.retro_game_id)
+            if not game_progress:
+                # Couldn't get progress for this game, try again next refresh
+                continue
             player_score = player_scores.filter(player_id=player.pk, game_id=game.pk).first()
             if not player_score or player_score.raw_score != game_progress.score_achieved_hardcore:
                 players_needing_update.append(player)
                 break
     
+    # Fetch everything before writing anything, so the write lock isn't held during the API calls
+    players_achievements = dict()
+    for player in players_needing_update:
+        if force:
+            start = challenge.start
+        else:
+            max_date = get_latest_achievement_date(player, challenge_id)
+            # Only get achievments starting 1s after the date of the latest achievement, if any.
+            start = max_date.timestamp() + 1 if max_date else challenge.start
+        players_achievements[player.pk] = client.get_achievements_earned_between(player.name, start, challenge.end)
+
+    # Lock the players so overlapping refreshes of the same player take turns writing,
+    # and the second one sees what the first stored rather than storing it again
+    list(Player.objects.select_for_update().filter(pk__in=[player.pk for player in players_needing_update]).order_by('pk'))
+
     scores_to_update = list()
     scores_to_create = list()
 
     for player in players_needing_update:
-        # print(player)
-        max_date = Achievement.objects.filter(player_id=player.pk).aggregate(Max('date'))['date__max']
-        # Only get achievments starting 1s after the date of the latest achievement, if any.
-        start = max_date.timestamp() + 1 if max_date else challenge.start
-        achievements_earned_between = client.get_achievements_earned_between(player.name, start, challenge.end)
+        if force:
+            Achievement.objects.filter(player=player, game__challenge_id=challenge_id).delete()
+            max_date = None
+        else:
+            max_date = get_latest_achievement_date(player, challenge_id)
+
         achievements_to_store = list()
 
-        for remote_achievement in achievements_earned_between.achievements:
+        for remote_achievement in players_achievements[player.pk].achievements:
             # TODO: Should probably check the remote_achievement for missing data
             game = games.filter(retro_game_id=remote_achievement.game_id).first()
-            # Don't store achievements for games not in the challenge
-            if game:
+            # Don't store achievements for games not in the challenge, or that another refresh already stored
+            if game and not (max_date and remote_achievement.date and remote_achievement.date <= max_date):
                 achievement = Achievement()
                 achievement.player = player
                 achievement.game = game
@@ -142,7 +227,7 @@ def refresh_leaderboard_smart(challenge_id: int):
         # Update PlayerScores
         user_progress = players_progress[player.name]
         for game in games:
-            game_progress = user_progress[game.retro_game_id]
+            game_progress = user_progress.get(game.retro_game_id)
             player_score = player_scores.filter(player_id=player.pk, game_id=game.pk).first()
             if not player_score:
                 player_score = PlayerScore()
@@ -153,13 +238,46 @@ def refresh_leaderboard_smart(challenge_id: int):
                 scores_to_update.append(player_score)
             hardcore_sum = Achievement.objects.filter(player=player, game=game, hardcore=True).aggregate(Sum('points'))['points__sum']
             player_score.score = hardcore_sum or 0
-            player_score.raw_score = game_progress.score_achieved_hardcore    
+            # Without progress keep the old raw_score so the next refresh checks this game again
+            if game_progress:
+                player_score.raw_score = game_progress.score_achieved_hardcore
         
     PlayerScore.objects.bulk_create(scores_to_create)
     PlayerScore.objects.bulk_update(scores_to_update, ['score', 'raw_score'])
 
     return ', '.join([player.name for player in players_needing_update])
 
+RESYNC_SETTING_PREFIX = 'resync_'
+
+def resync_player(player: Player, client: RAclient = None):
+    '''
+    Refetches the player's achievements for every current challenge they're in. This can take
+    dozens of rate-limited requests, so it's run from the resync_player command rather than a web request.
+    '''
+    group_ids = set(player.groups.values_list('id', flat=True))
+    for challenge in get_current_challenges():
+        if not challenge.group_id or challenge.group_id in group_ids:
+            refresh_leaderboard_smart(challenge.id, players=[player], force=True, client=client)
+
+def queue_resync(player: Player):
+    '''
+    Queues the player for the next `resync_player --queued` or refresh_groups run
+    '''
+    Setting.objects.get_or_create(name=f'{RESYNC_SETTING_PREFIX}{player.pk}', defaults={'value': player.name})
+
+def run_queued_resyncs(client: RAclient = None):
+    '''
+    Resyncs every queued player, returning their names. A player stays queued if their resync fails.
+    '''
+    resynced = list()
+    for setting in Setting.objects.filter(name__startswith=RESYNC_SETTING_PREFIX):
+        player = Player.objects.filter(pk=setting.name[len(RESYNC_SETTING_PREFIX):]).first()
+        if player:
+            resync_player(player, client)
+            resynced.append(player.name)
+        setting.delete()
+    return resynced
+
 @staff_member_required
 def import_players(request):
     response = ''
@@ -175,17 +293,20 @@ def import_players(request):
 
 @staff_member_required
 def import_games(request):
-    username = Setting.objects.filter(name='username')[0].value
-    api_key = Setting.objects.filter(name='api_key')[0]
+    username, api_key = get_login()
+    client = RAclient(username, api_key, Priority.BULK)
     response = ''
+    # The same game can be in several challenges, only fetch it once
+    games_data = dict()
     with open(r'./games.csv', newline='') as csvfile:
         reader = csv.reader(csvfile, delimiter=',', quotechar='"')
         for row in reader:
             retro_game_id = int(row[0])
             challenge_id = int(row[1])
-            game = Game(retro_game_id = retro_game_id, challenge_id=challenge_id)
-            client = RAclient(username, api_key)
-            game_data = client.get_game(retro_game_id)
+            game = Game.objects.filter(retro_game_id=retro_game_id, challenge_id=challenge_id).first() or Game(retro_game_id=retro_game_id, challenge_id=challenge_id)
+            if retro_game_id not in games_data:
+                games_data[retro_game_id] = client.get_game(retro_game_id)
+            game_data = games_data[retro_game_id]
             game.name = game_data['Title']
             game.image_icon = game_data['ImageIcon']
             game.game_icon = game_data['GameIcon']
@@ -200,14 +321,17 @@ def import_games(request):
 @staff_member_required
 def refresh_games(request):
     username, api_key = get_login()
-    client = RAclient(username, api_key)
+    client = RAclient(username, api_key, Priority.BULK)
     response = ''
 
-    challenge_id = get_max_challenge_id()
-    games = Game.objects.filter(challenge__id=challenge_id).order_by('retro_game_id')
+    games = Game.objects.filter(challenge__in=get_current_challenges()).order_by('retro_game_id')
+    # Groups running the same game share one request
+    games_data = dict()
 
     for game in games:
-        data = client.get_game(game.retro_game_id)
+        if game.retro_game_id not in games_data:
+            games_data[game.retro_game_id] = client.get_game(game.retro_game_id)
+        data = games_data[game.retro_game_id]
         game.name = data['Title']
         game.image_icon = data['ImageIcon']
         game.game_icon = data['GameIcon']